@@ -3,20 +3,39 @@ import asyncio
 import datetime
 import time
 import random
+import re
+import sys
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Any
+from typing import Optional
 
 from astrbot.api.all import *
 from astrbot.api.star import Star, Context, register
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.message_components import Record, Poke
 from astrbot.api import logger
-from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import AiocqhttpMessageEvent
 
 from .voice_manager import VoiceManager
 from .scheduler import VoiceScheduler
 from .sentiment_analyzer import SentimentAnalyzer
 
+# 插件内共享的随机数生成器
+_rng = random.Random()
+
+class SessionState:
+    """单个会话的决策状态 (slots 以压缩大量会话时的内存占用)"""
+    __slots__ = ("last_tag", "last_trigger", "mood_tag", "mood_expiry")
+
+    def __init__(self):
+        self.last_tag: Optional[str] = None
+        self.last_trigger = float("-inf")  # 上次触发的 monotonic 时间
+        self.mood_tag: Optional[str] = None  # 当前持续的情绪状态
+        self.mood_expiry = 0.0               # 情绪过期的 monotonic 时间
+
+
+# 视为戳一戳的消息组件类型 (按确切类型查表，适配器有新类型时在此登记)
+POKE_COMPONENT_TYPES = frozenset({Poke})
+
 @register(
     "echo_of_theresia",
     "riceshowerX",
@@ -29,13 +48,17 @@ class TheresiaVoicePlugin(Star):
         super().__init__(context)
         self.config = config or {}
         self._init_default_config()
+        self._load_runtime_params()
 
         self.plugin_root = Path(__file__).parent.resolve()
 
         # === 核心状态管理 ===
-        # 结构: { session_id: { last_tag, last_trigger, mood_tag, mood_expiry } }
-        self.session_state: Dict[str, Dict[str, Any]] = {}
+        # 结构: { session_id: SessionState }，按最近访问排序的 LRU
+        self.session_state: "OrderedDict[str, SessionState]" = OrderedDict()
         self.MAX_CACHE_SIZE = 500  # 最大缓存会话数 (防止内存泄漏)
+        self.ANALYZE_OFFLOAD_LEN = 200  # 超过此长度的文本在工作线程中做情感分析
+        # 当前小时缓存: (有效期截止的 monotonic 时间, 小时)
+        self._hour_cache = (float("-inf"), 0)
 
         # === 初始化各模块 ===
         self.voice_manager = VoiceManager(self)
@@ -44,12 +67,14 @@ class TheresiaVoicePlugin(Star):
         self.analyzer = SentimentAnalyzer() # 情感分析引擎
 
     async def on_load(self):
+        asyncio.create_task(asyncio.to_thread(self.voice_manager.prewarm))
         if self.config.get("enabled", True):
             asyncio.create_task(self.scheduler.start())
         logger.info("[Echo of Theresia] 核心逻辑已装载 (Adaptive Decision System Online)")
 
     async def on_unload(self):
         await self.scheduler.stop()
+        self.analyzer.flush_context()
 
     # ==================== 配置 ====================
 
@@ -58,6 +83,7 @@ class TheresiaVoicePlugin(Star):
         self.config.setdefault("command.keywords", ["特雷西娅", "特蕾西娅", "Theresia"])
         self.config.setdefault("command.prefix", "/theresia")
         self.config.setdefault("voice.default_tag", "")
+        self.config.setdefault("voice.preload", False)
 
         # 功能开关
         self.config.setdefault("features.sanity_mode", True)
@@ -81,7 +107,64 @@ class TheresiaVoicePlugin(Star):
         self.config.setdefault("schedule.target_sessions", [])
         self.config.setdefault("schedule.weekday", 1)
 
+    # 预解析参数所依赖的配置项，用于检测 WebUI 直接修改配置 (不经过 _save_config)
+    RUNTIME_PARAM_KEYS = (
+        "params.base_cooldown", "params.high_emotion_cd", "params.mood_duration",
+        "command.keywords", "command.prefix",
+        "features.sanity_mode", "sanity.night_start", "sanity.night_end",
+    )
+    # 配置变更检测的最小间隔 (秒)
+    RUNTIME_PARAM_CHECK_INTERVAL = 1.0
+
+    def _runtime_params_signature(self) -> tuple:
+        return tuple(
+            tuple(v) if isinstance(v, list) else v
+            for v in map(self.config.get, self.RUNTIME_PARAM_KEYS)
+        )
+
+    def _refresh_runtime_params(self):
+        """配置在 WebUI 中修改后会直接生效于 self.config，按签名检测并重新预解析 (限频)"""
+        mono = time.monotonic()
+        if mono < self._params_check_at:
+            return
+        self._params_check_at = mono + self.RUNTIME_PARAM_CHECK_INTERVAL
+        if self._runtime_params_signature() != self._params_signature:
+            self._load_runtime_params()
+
+    def _load_runtime_params(self):
+        """将热路径上频繁读取的配置项预解析为属性，配置变更后需重新调用"""
+        self._params_signature = self._runtime_params_signature()
+        self._params_check_at = time.monotonic() + self.RUNTIME_PARAM_CHECK_INTERVAL
+        self._cd_base = int(self.config.get("params.base_cooldown", 15))
+        self._cd_high = int(self.config.get("params.high_emotion_cd", 5))
+        # 会话状态存活时间：冷却与情绪惯性都已失效许久的会话不再保留
+        self._cd_min = min(self._cd_base, self._cd_high)
+        self._session_ttl = 4 * max(
+            int(self.config.get("params.mood_duration", 60)), self._cd_base, self._cd_high
+        )
+        self._kw_lower = tuple(str(k).lower() for k in self.config.get("command.keywords", []))
+        self._cmd_prefix_lower = str(self.config.get("command.prefix", "/theresia")).lower()
+        # 指令前缀及其全角斜杠写法，供 str.startswith(tuple) 一次判定
+        self._cmd_prefixes = tuple(dict.fromkeys(
+            (self._cmd_prefix_lower, self._cmd_prefix_lower.replace("/", "／"))
+        ))
+        # 全部触发词合并为单个正则，一次扫描判断是否可能触发
+        kws = sorted({k for k in self._kw_lower if k}, key=len, reverse=True)
+        self._trigger_re = re.compile("|".join(map(re.escape, kws))) if kws else None
+        # 深夜时段的 24 位掩码 (第 h 位表示 h 点属于深夜)，支持跨零点区间如 23 -> 5
+        self._night_mask = 0
+        if self.config.get("features.sanity_mode", True):
+            night_start = int(self.config.get("sanity.night_start", 1)) % 24
+            night_end = int(self.config.get("sanity.night_end", 5)) % 24
+            h = night_start
+            while h != night_end:
+                self._night_mask |= 1 << h
+                h = (h + 1) % 24
+        # 触发词首字符集合：str 的 in 查找走 C 层快速扫描，先以此粗筛
+        self._trigger_seeds = tuple({k[0] for k in kws})
+
     def _save_config(self):
+        self._load_runtime_params()
         try:
             if hasattr(self.config, "save_config"):
                 self.config.save_config()
@@ -91,44 +174,49 @@ class TheresiaVoicePlugin(Star):
     # ==================== 状态管理 (LRU 机制) ====================
 
     def _get_session_state(self, session_id):
-        now = time.time()
-        
-        # 如果不存在，创建新状态
-        if session_id not in self.session_state:
-            # 内存清理：如果超过最大缓存，清理最老的 20%
-            if len(self.session_state) >= self.MAX_CACHE_SIZE:
-                # 按 last_trigger 排序，取旧的删除
-                sorted_keys = sorted(self.session_state.keys(), key=lambda k: self.session_state[k]['last_trigger'])
-                for k in sorted_keys[:int(self.MAX_CACHE_SIZE * 0.2)]:
-                    del self.session_state[k]
-            
-            self.session_state[session_id] = {
-                "last_tag": None,
-                "last_trigger": 0,
-                "mood_tag": None,    # 当前持续的情绪状态
-                "mood_expiry": 0     # 情绪过期时间戳
-            }
-        
-        return self.session_state[session_id]
+        state = self.session_state.get(session_id)
+        if state is not None:
+            self.session_state.move_to_end(session_id)
+            return state
+
+        # 内存清理：队首即最久未访问的会话，先淘汰已过存活期的，再按容量淘汰
+        expire_before = time.monotonic() - self._session_ttl
+        while self.session_state:
+            oldest = next(iter(self.session_state.values()))
+            if oldest.last_trigger >= expire_before:
+                break
+            self.session_state.popitem(last=False)
+        while len(self.session_state) >= self.MAX_CACHE_SIZE:
+            self.session_state.popitem(last=False)
+
+        state = self.session_state[session_id] = SessionState()
+        return state
+
+    def _current_hour(self) -> int:
+        """本地时间的小时数，缓存到下一个整点，避免每条消息都构造 datetime"""
+        mono = time.monotonic()
+        expiry, hour = self._hour_cache
+        if mono < expiry:
+            return hour
+        now = datetime.datetime.now()
+        remaining = 3600 - (now.minute * 60 + now.second + now.microsecond / 1e6)
+        self._hour_cache = (mono + remaining, now.hour)
+        return now.hour
 
     # ==================== 安全发送语音 ====================
 
-    async def safe_yield_voice(self, event: AstrMessageEvent, rel_path: str | None):
-        if not rel_path:
-            # 仅在指令模式下提示找不到
-            if event.message_str and event.message_str.strip().startswith("/"):
-                yield event.plain_result("特雷西娅似乎没有找到这段语音呢~")
-            return
-
-        abs_path = (self.plugin_root / rel_path).resolve()
-        if not abs_path.exists():
+    def build_voice_reply(self, event: AstrMessageEvent, rel_path: str):
+        """构造语音消息链，文件缺失或构造失败时返回 None"""
+        record_file = self.voice_manager.get_record_file(rel_path)
+        if record_file is None:
             logger.warning(f"[Echo] 文件缺失: {rel_path}")
-            return
+            return None
 
         try:
-            yield event.chain_result([Record(file=str(abs_path))])
+            return event.chain_result([Record(file=record_file)])
         except Exception as e:
             logger.error(f"[Echo] 发送失败: {e} | session={event.session_id}")
+            return None
 
     # ==================== 核心决策算法 ====================
 
@@ -136,13 +224,13 @@ class TheresiaVoicePlugin(Star):
         """
         自适应决策逻辑：结合当前情绪、历史情绪惯性、环境时间来选择最佳 Tag
         """
-        now = time.time()
+        now = time.monotonic()
         candidates = []
         
         # 1. 情绪惯性检查 (Emotional Inertia)
         # 如果之前处于强烈情绪(如哭泣、害怕)且未过期，且当前输入没有强烈的反向情绪，保持惯性
-        mood_tag = session_state.get("mood_tag")
-        mood_expiry = session_state.get("mood_expiry", 0)
+        mood_tag = session_state.mood_tag
+        mood_expiry = session_state.mood_expiry
         
         has_strong_mood = (mood_tag is not None) and (now < mood_expiry)
         
@@ -164,58 +252,66 @@ class TheresiaVoicePlugin(Star):
         if base_tag:
             candidates.append(base_tag)
 
-        # 去重
-        candidates = list(set(candidates))
+        # 去重 (保持加入顺序)
+        candidates = list(dict.fromkeys(candidates))
         if not candidates:
             return None
 
-        # 3. 权重加权选择
+        # 3. 权重加权选择 (循环不变量提到循环外)
+        sentiment_bonus = sentiment_score * 0.5  # 分数越高权重越大
+        inertia_tag = mood_tag if has_strong_mood else None
+        last_tag = session_state.last_tag
         weights = []
         for tag in candidates:
             w = 1.0
             # 命中当前识别出的情绪，权重极高
             if tag == sentiment_tag:
-                w += sentiment_score * 0.5  # 分数越高权重越大
+                w += sentiment_bonus
             
             # 命中惯性情绪，权重加成
-            if tag == mood_tag and has_strong_mood:
+            if tag == inertia_tag:
                 w += 3.0
             
             # 避免重复：如果是上一条发过的，大幅降权
-            if tag == session_state["last_tag"]:
+            if tag == last_tag:
                 w *= 0.1
             
             weights.append(w)
 
-        final_tag = random.choices(candidates, weights=weights, k=1)[0]
+        # 候选至多数个，直接用单个随机数沿权重累减选取，省去 random.choices 的累积表
+        r = _rng.random() * sum(weights)
+        final_tag = candidates[-1]
+        for tag, w in zip(candidates, weights):
+            r -= w
+            if r < 0:
+                final_tag = tag
+                break
         
         # 4. 更新情绪惯性状态
         # 只有当情绪分很高(例如 > 8)时，才更新惯性状态
         if sentiment_tag and sentiment_score >= 8:
-            session_state["mood_tag"] = sentiment_tag
+            session_state.mood_tag = sys.intern(sentiment_tag)
             duration = self.config.get("params.mood_duration", 60)
-            session_state["mood_expiry"] = now + duration
+            session_state.mood_expiry = now + duration
         
         # 如果选出了sanity(理智/晚安)，通常意味着结束对话，清除负面情绪惯性
         if final_tag == "sanity":
-             session_state["mood_expiry"] = 0
+             session_state.mood_expiry = 0.0
 
         return final_tag
 
-    # ==================== 戳一戳触发 ====================
+    # ==================== 戳一戳 ====================
 
-    @filter.event_message_type(filter.EventMessageType.ALL)
-    async def poke_trigger(self, event: AiocqhttpMessageEvent):
+    def _poke_reply(self, event: AstrMessageEvent):
+        """处理戳一戳：戳的是机器人本身时返回语音回复，否则返回 None"""
         raw_message = getattr(event.message_obj, "raw_message", None)
-
-        if (not raw_message or not event.message_obj.message or 
-            not isinstance(event.message_obj.message[0], Poke)):
-            return
+        if not raw_message:
+            return None
 
         target_id = raw_message.get("target_id", 0)
         self_id = raw_message.get("self_id", 0)
         if target_id != self_id:
-            return
+            return None
 
         # 构造兼容事件
         fake_event = AstrMessageEvent(
@@ -228,9 +324,10 @@ class TheresiaVoicePlugin(Star):
         # 戳一戳通常不走复杂决策，直接回应
         tag = "poke"
         rel_path = self.voice_manager.get_voice(tag) or self.voice_manager.get_voice(None)
-        
-        async for msg in self.safe_yield_voice(fake_event, rel_path):
-            yield msg
+        if not rel_path:
+            return None
+
+        return self.build_voice_reply(fake_event, rel_path)
 
     # ==================== 文本关键词触发 ====================
 
@@ -239,49 +336,74 @@ class TheresiaVoicePlugin(Star):
         if not self.config.get("enabled", True):
             return
 
+        # 戳一戳与文本触发共用同一个 ALL 处理器，避免每条消息被分发两次
+        # 首组件类型查表开销极低，普通消息在此即可排除
+        chain = event.message_obj.message
+        if chain and type(chain[0]) in POKE_COMPONENT_TYPES:
+            if self.config.get("features.nudge_response", True):
+                reply = self._poke_reply(event)
+                if reply is not None:
+                    yield reply
+            return
+
+        # WebUI 修改的触发词/冷却等配置在此生效
+        self._refresh_runtime_params()
+
+        # 统一预处理：strip/lower 只做一次，后续检测与情感分析共用
         text = (event.message_str or "").strip()
-        text_lower = text.lower()
         if not text: return
+        text_lower = text.lower()
+
+        # 以下检测按开销从低到高排列，尽早返回
 
-        # 指令过滤
-        if text_lower.startswith(self.config.get("command.prefix", "/theresia").lower()): return
-        if text_lower.split(" ", 1)[0] == "theresia": return
+        # 指令过滤 (仅比较开头几个字符)
+        if text_lower.startswith(self._cmd_prefixes): return
+        if text_lower == "theresia" or text_lower.startswith("theresia "): return
 
-        # 关键词检测
-        keywords = [str(k).lower() for k in self.config.get("command.keywords", [])]
-        if not any(k in text_lower for k in keywords):
+        # 关键词检测：绝大多数消息不含触发词
+        # 先查首字符 (长消息上远快于正则扫描)，再用合并正则精确匹配
+        for c in self._trigger_seeds:
+            if c in text_lower:
+                break
+        else:
+            return
+        if not self._trigger_re.search(text_lower):
             return
 
         # === 自适应冷却检测 (ACD) ===
-        state = self._get_session_state(event.session_id)
-        now = time.time()
-        last_time = state["last_trigger"]
-        
+        # 快速路径：仍处于最短冷却内时无论情绪如何都不会回应，跳过情感分析与状态分配
+        now = time.monotonic()
+        state = self.session_state.get(event.session_id)
+        if state is not None and now - state.last_trigger < self._cd_min:
+            return
+
         # 预先分析情绪，用于判断 CD
         sentiment_tag, sentiment_score = (None, 0)
         if self.config.get("features.emotion_detect", True):
-            sentiment_tag, sentiment_score = self.analyzer.analyze(
-                text, 
-                enable_negation=self.config.get("features.smart_negation", True)
-            )
-
-        # 动态 CD 计算
-        base_cd = self.config.get("params.base_cooldown", 15)
-        # 算法：情绪越激动(分数高)，CD越短，最低5秒
-        if sentiment_score >= 8:
-            actual_cd = self.config.get("params.high_emotion_cd", 5)
-        else:
-            actual_cd = base_cd
-            
-        if now - last_time < actual_cd:
+            analyze_kwargs = {
+                "enable_negation": self.config.get("features.smart_negation", True),
+                "text_lower": text_lower,
+            }
+            if len(text) > self.ANALYZE_OFFLOAD_LEN:
+                # 长文本分析耗时可达毫秒级，放到工作线程以免阻塞事件循环
+                sentiment_tag, sentiment_score = await asyncio.to_thread(
+                    self.analyzer.analyze, text, **analyze_kwargs
+                )
+                now = time.monotonic()
+            else:
+                sentiment_tag, sentiment_score = self.analyzer.analyze(text, **analyze_kwargs)
+
+        # 分析之后才取状态：此后直到发送都不再让出事件循环，冷却判定与状态更新不会交错
+        state = self._get_session_state(event.session_id)
+
+        # 动态 CD：情绪越激动(分数高)，CD越短
+        if now - state.last_trigger < (self._cd_high if sentiment_score >= 8 else self._cd_base):
             return # 冷却中
 
         # === 执行决策 ===
         # 环境判断
-        hour = datetime.datetime.now().hour
-        night_start = int(self.config.get("sanity.night_start", 1))
-        night_end = int(self.config.get("sanity.night_end", 5))
-        is_late_night = night_start <= hour < night_end
+        hour = self._current_hour()
+        is_late_night = bool((self._night_mask >> hour) & 1)
         
         base_tag = self.config.get("voice.default_tag", "")
 
@@ -294,20 +416,23 @@ class TheresiaVoicePlugin(Star):
         )
 
         # 更新状态
-        state["last_trigger"] = now
-        state["last_tag"] = final_tag
+        state.last_trigger = now
+        state.last_tag = sys.intern(final_tag) if final_tag else None
 
-        async for msg in self.send_voice_by_tag(event, final_tag):
-            yield msg
+        reply = self.voice_reply_by_tag(event, final_tag)
+        if reply is not None:
+            yield reply
 
-    async def send_voice_by_tag(self, event: AstrMessageEvent, tag: str | None):
+    def voice_reply_by_tag(self, event: AstrMessageEvent, tag: str | None):
+        """按标签选取语音并构造回复，标签无匹配时回退到随机语音；无可用语音返回 None"""
         rel_path = self.voice_manager.get_voice(tag or None)
         if not rel_path and tag:
             rel_path = self.voice_manager.get_voice(None)
 
-        if rel_path:
-            async for msg in self.safe_yield_voice(event, rel_path):
-                yield msg
+        if not rel_path:
+            return None
+
+        return self.build_voice_reply(event, rel_path)
 
     # ==================== 指令系统 ====================
 
@@ -325,19 +450,19 @@ class TheresiaVoicePlugin(Star):
         elif action == "enable":
             self.config["enabled"] = True
             self._save_config()
-            asyncio.create_task(self.scheduler.start())
+            await self.scheduler.start()
             yield event.plain_result("特雷西娅语音插件已启用♪")
 
         elif action == "disable":
             self.config["enabled"] = False
             self._save_config()
-            asyncio.create_task(self.scheduler.stop())
+            await self.scheduler.stop()
             yield event.plain_result("特雷西娅语音插件已禁用。")
 
         elif action == "voice":
             tag = (payload or self.config.get("voice.default_tag", "")).strip() or None
-            async for msg in self.send_voice_by_tag(event, tag):
-                yield msg
+            reply = self.voice_reply_by_tag(event, tag)
+            yield reply if reply is not None else event.plain_result("特雷西娅似乎没有找到这段语音呢~")
 
         elif action == "tags":
             tags = self.voice_manager.get_tags()
@@ -347,14 +472,15 @@ class TheresiaVoicePlugin(Star):
             yield event.plain_result("\n".join(lines))
 
         elif action == "update":
-            self.voice_manager.update_voices()
+            # 扫描目录可能较慢，放到工作线程执行以免阻塞事件循环
+            await asyncio.to_thread(self.voice_manager.update_voices)
             total = self.voice_manager.get_voice_count()
             yield event.plain_result(f"更新完成！共 {total} 条语音。")
         
         elif action == "status":
-            # 调试用：查看当前会话状态
-            state = self._get_session_state(event.session_id)
-            mood = state.get('mood_tag') if time.time() < state.get('mood_expiry', 0) else "None"
+            # 调试用：查看当前会话状态 (只读，不为未触发过的会话分配状态)
+            state = self.session_state.get(event.session_id)
+            mood = state.mood_tag if state and time.monotonic() < state.mood_expiry else "None"
             yield event.plain_result(f"当前会话状态:\nMood: {mood}\nSessions Cached: {len(self.session_state)}")
 
         elif action == "set_target":
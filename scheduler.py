@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import datetime
+import itertools
 import time
 import random
+import re
 import json
 from pathlib import Path
 from typing import List, Optional, Dict, Set
@@ -10,7 +12,30 @@ from typing import List, Optional, Dict, Set
 from astrbot.api import logger
 from astrbot.api.message_components import Record
 
-class VoiceScheduler:
+from .sentiment_analyzer import ThreadSafeIO
+
+# schedule.time 格式：H:MM / HH:MM (24 小时制)
+_TIME_RE = re.compile(r"([01]?\d|2[0-3]):([0-5]?\d)")
+
+
+class ScheduleSnapshot:
+    """定时任务配置快照：配置变更时整体重建，循环内只读属性，不再反复查配置字典"""
+    __slots__ = ("enabled", "hour", "minute", "time_valid", "freq", "voice_tags", "targets")
+
+    def __init__(self, cfg):
+        self.enabled = bool(cfg.get("enabled", True) and cfg.get("schedule.enabled", False))
+        m = _TIME_RE.fullmatch(str(cfg.get("schedule.time", "08:00")).strip())
+        self.time_valid = m is not None
+        self.hour, self.minute = (int(m[1]), int(m[2])) if m else (8, 0)
+        self.freq = str(cfg.get("schedule.frequency", "daily")).lower()
+        self.voice_tags = tuple(cfg.get("schedule.voice_tags", []))
+        self.targets = tuple(str(s) for s in cfg.get("schedule.target_sessions", []))
+
+    def signature(self) -> tuple:
+        return (self.enabled, self.hour, self.minute, self.freq, self.voice_tags, self.targets)
+
+
+class VoiceScheduler(ThreadSafeIO):
 
     def __init__(self, plugin, voice_manager):
         self.plugin = plugin
@@ -18,65 +43,137 @@ class VoiceScheduler:
 
         self.running = False
         self.task: Optional[asyncio.Task] = None
+        # 串行化启停，快速反复 enable/disable 时合并冗余切换
+        self._state_lock = asyncio.Lock()
 
         # 记录发送状态: { session_id: last_sent_key }
-        self.session_sent_keys: Dict[str, str] = {}
+        # key 为整数周期编号 (见 _generate_time_key)，不同频率的编号可能重叠，切换频率时清空
+        self.session_sent_keys: Dict[str, int] = {}
+        self._keys_freq: Optional[str] = None
+        # 发送状态持久化：重启后不会对已发过的周期重复推送
+        self.state_path = Path(__file__).parent / "data" / "scheduler_state.json"
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self._load_sent_keys()
+
+        # 定时目标集合：仅接收推送的会话只登记在这里，不占用插件的 session_state
+        self._sched = ScheduleSnapshot(self.plugin.config)
+        self.target_set: Set[str] = set(self._sched.targets)
         
         # 宽容窗口 (秒): 错过时间点多久内允许补发
         self.GRACE_PERIOD = 1800 
         
-        self._last_config_signature = ""
+        self._last_config_signature: Optional[tuple] = None
+
+        # 唤醒事件：目标/开关变更时打断休眠，立即重新计算下一次触发时间
+        self._wake_event = asyncio.Event()
+        # 无事件时的最长休眠 (秒)，兜底感知 WebUI 上的配置修改与系统时钟跳变
+        self.MAX_IDLE_SLEEP = 300
+        # 启动抖动上限 (秒)：多实例同时启动时错开首次判定，避免同一时刻集中推送
+        self.START_JITTER = 30
+        # 时钟分辨率：事件循环允许定时器提前至多一个分辨率触发，判定窗口下界据此放宽
+        self._clock_res = time.get_clock_info("monotonic").resolution
+
+        # 发送接口：启动时探测一次，发送时直接调用
+        self._send_fn = None
+        # 并发发送上限：抖动窗口内同时在途的发送请求数，避免目标很多时瞬时打满平台接口
+        self.SEND_CONCURRENCY = 8
+        self._send_sem = asyncio.Semaphore(self.SEND_CONCURRENCY)
 
     # ==================== 生命周期 ====================
 
     async def start(self):
-        if self.running: return
-        self.running = True
-        self.task = asyncio.create_task(self._loop())
-        logger.info("[Echo Scheduler v3.0] 拟人化调度服务已挂载")
+        async with self._state_lock:
+            if self.running:
+                self.wake()
+                return
+            self.running = True
+            self._send_fn = self._resolve_send_fn()
+            self.task = asyncio.create_task(self._loop())
+            logger.info("[Echo Scheduler v3.0] 拟人化调度服务已挂载")
 
     async def stop(self):
-        self.running = False
-        if self.task:
-            self.task.cancel()
-            try:
-                await self.task
-            except asyncio.CancelledError:
-                pass
-            self.task = None
-        logger.info("[Echo Scheduler v3.0] 服务已卸载")
+        async with self._state_lock:
+            if not self.running and not self.task: return
+            self.running = False
+            if self.task:
+                self.task.cancel()
+                try:
+                    await self.task
+                except asyncio.CancelledError:
+                    pass
+                self.task = None
+            logger.info("[Echo Scheduler v3.0] 服务已卸载")
+
+    def wake(self):
+        """打断当前休眠，让循环立即重新判定"""
+        self._wake_event.set()
+
+    def _resolve_send_fn(self):
+        """探测框架提供的主动发送接口 (不同版本 AstrBot 位置不同)"""
+        ctx = self.plugin.context
+        if hasattr(ctx, "send_message"):
+            return ctx.send_message
+        if hasattr(ctx, "message_sender"):
+            return ctx.message_sender.send_message
+        logger.warning("[定时任务] 当前 AstrBot 版本未提供主动发送接口，定时语音将无法发送")
+        return None
+
+    # ==================== 目标管理 ====================
+
+    async def add_target(self, session_id: str):
+        session_id = str(session_id)
+        if session_id in self.target_set:
+            return
+        self.target_set.add(session_id)
+        self._sync_targets()
+
+    async def remove_target(self, session_id: str):
+        session_id = str(session_id)
+        if session_id not in self.target_set:
+            return
+        self.target_set.discard(session_id)
+        self.session_sent_keys.pop(session_id, None)
+        self._sync_targets()
+
+    def _sync_targets(self):
+        """将目标集合回写到配置并持久化"""
+        self.plugin.config["schedule.target_sessions"] = sorted(self.target_set)
+        self.plugin._save_config()
+        self.wake()
 
     # ==================== 核心循环 ====================
 
     async def _loop(self):
         logger.info("[定时任务] 监听循环启动...")
+        await asyncio.sleep(random.uniform(0, self.START_JITTER))
         while self.running:
             try:
                 # 1. 热更新检测
                 if self._config_changed():
+                    self.target_set = set(self._sched.targets)
+                    # 清理已不在目标列表中的会话 (如在 WebUI 中直接删除的目标)
+                    self.session_sent_keys = {
+                        sid: key for sid, key in self.session_sent_keys.items() if sid in self.target_set
+                    }
                     logger.info("[定时任务] 配置热重载完成")
 
                 if not self._is_enabled():
-                    await asyncio.sleep(30)
+                    await self._sleep(self.MAX_IDLE_SLEEP)
                     continue
 
                 # 2. 计算触发状态
-                # 返回: (是否触发, 触发类型key, 是否是补发)
-                should_trigger, trigger_key, is_compensation = self._check_trigger_condition()
+                # 返回: (待发送会话列表, 触发类型key, 是否是补发)
+                pending, trigger_key, is_compensation = self._check_trigger_condition()
 
-                if should_trigger:
+                if pending:
                     action_type = "断点补发" if is_compensation else "定时触发"
                     logger.info(f"[定时任务] {action_type} 条件满足 (Key: {trigger_key})")
                     
                     # 执行分发
-                    await self._execute_dispatch(trigger_key, is_compensation)
-                    
-                    # 等待一会防止重复判定
-                    await asyncio.sleep(5)
-                else:
-                    # 没到时间，智能休眠
-                    # 这里不再 sleep(distance)，因为要保持一定的响应频率以检测配置变更
-                    await asyncio.sleep(5)
+                    await self._execute_dispatch(pending, trigger_key, is_compensation)
+
+                # 3. 直接休眠到下一个触发点，期间的配置/目标变更通过 wake() 打断
+                await self._sleep(min(self._seconds_until_next_trigger(), self.MAX_IDLE_SLEEP))
 
             except asyncio.CancelledError:
                 break
@@ -84,68 +181,84 @@ class VoiceScheduler:
                 logger.error(f"[定时任务] 循环异常: {e}")
                 await asyncio.sleep(60)
 
+    async def _sleep(self, seconds: float):
+        """可被 wake() 打断的休眠"""
+        try:
+            await asyncio.wait_for(self._wake_event.wait(), timeout=max(seconds, 1.0))
+        except asyncio.TimeoutError:
+            pass
+        self._wake_event.clear()
+
     # ==================== 触发判定逻辑 ====================
 
-    def _check_trigger_condition(self) -> (bool, str, bool):
+    def _seconds_until_next_trigger(self) -> float:
+        """距离下一个理论触发时间点的秒数"""
+        freq = self._sched.freq
+        now = datetime.datetime.now()
+        target_dt = self._get_target_datetime(freq, now)
+        if target_dt <= now:
+            # 本周期的时间点已过 (已发送或超出宽容期)，等下一个周期
+            step = datetime.timedelta(hours=1) if freq == "hourly" else datetime.timedelta(days=1)
+            target_dt += step
+        return (target_dt - now).total_seconds()
+
+    def _check_trigger_condition(self) -> (List[str], int, bool):
         """
         判断当前是否应该触发。
         包含算法：断点补偿检测
         """
-        freq = self.plugin.config.get("schedule.frequency", "daily").lower()
+        freq = self._sched.freq
         now = datetime.datetime.now()
 
-        # 1. 构造当前的 Time Key
-        trigger_key = self._generate_time_key(freq, now)
-        if not trigger_key:
-            return False, "", False
+        if freq != self._keys_freq:
+            self.session_sent_keys.clear()
+            self._keys_freq = freq
 
-        # 2. 解析目标时间 (用于计算宽容度)
+        # 1. 解析目标时间 (用于计算宽容度)
         target_dt = self._get_target_datetime(freq, now)
         delta = (now - target_dt).total_seconds()
 
+        # 2. 构造目标时间所在周期的 Time Key
+        # 以目标时间而非当前时间计算：hourly 补发跨过整点时仍归属上一个周期
+        trigger_key = self._generate_time_key(freq, target_dt)
+        if trigger_key is None:
+            return [], 0, False
+
         # 3. 判定窗口
-        # 情况A: 正好在时间点附近 (0 <= delta < 60) -> 正常触发
+        # 情况A: 正好在时间点附近 (0 <= delta < 60，下界放宽一个时钟分辨率) -> 正常触发
         # 情况B: 错过了时间点，但在宽容期内 (60 <= delta < GRACE_PERIOD) -> 补偿触发
         # 情况C: 还没到 (<0) 或 错过太久 (>GRACE_PERIOD) -> 不触发
         
         is_compensation = False
-        if 0 <= delta < 60:
+        if -self._clock_res <= delta < 60:
             pass # 正常
         elif 60 <= delta < self.GRACE_PERIOD:
             is_compensation = True
         else:
-            return False, "", False
+            return [], 0, False
 
-        # 4. 检查是否已经发过 (全局检查，具体每个 Session 还会复查)
-        # 这里只要有一个目标没发过这个 Key，就应该触发流程
-        targets = self.plugin.config.get("schedule.target_sessions", [])
-        if not targets:
-            return False, "", False
-        
-        # 只要有一个 session 的 last_key 不等于 current_key，就说明需要触发
-        needs_trigger = any(self.session_sent_keys.get(sid) != trigger_key for sid in targets)
+        # 4. 筛出尚未发送过这个 Key 的会话，分发时只遍历这部分
+        pending = [sid for sid in self._sched.targets if self.session_sent_keys.get(sid) != trigger_key]
         
-        return needs_trigger, trigger_key, is_compensation
+        return pending, trigger_key, is_compensation
 
-    def _generate_time_key(self, freq: str, dt: datetime.datetime) -> str:
-        """生成用于去重的唯一时间键"""
+    def _generate_time_key(self, freq: str, dt: datetime.datetime) -> Optional[int]:
+        """生成用于去重的周期编号 (整数运算，无需 strftime 格式化)"""
+        day = dt.toordinal()
         if freq == "daily":
-            return dt.strftime("%Y-%m-%d") # 每天一个Key
+            return day # 每天一个Key
         elif freq == "hourly":
-            return dt.strftime("%Y-%m-%d-%H") # 每小时一个Key
+            return day * 24 + dt.hour # 每小时一个Key
         elif freq == "weekly":
-            return dt.strftime("%Y-W%W") # 每周一个Key
+            return day - dt.weekday() # 每周一个Key (本周一的日序号)
         elif freq == "once":
-            return "ONCE_TASK"
-        return ""
+            # 编入配置的时分：修改 schedule.time 即重新布置一次性推送
+            return dt.hour * 60 + dt.minute
+        return None
 
     def _get_target_datetime(self, freq: str, now: datetime.datetime) -> datetime.datetime:
         """反推当前的理论触发时间"""
-        time_str = self.plugin.config.get("schedule.time", "08:00")
-        try:
-            h, m = map(int, time_str.split(":"))
-        except:
-            h, m = 8, 0
+        h, m = self._sched.hour, self._sched.minute
         
         target = now.replace(hour=h, minute=m, second=0, microsecond=0)
         
@@ -156,7 +269,6 @@ class VoiceScheduler:
                 target -= datetime.timedelta(hours=1)
         
         elif freq == "weekly":
-            weekday = self.plugin.config.get("schedule.weekday", 1)
             # 简单处理：仅计算当天的目标时间，周几的判断交给 Key 匹配
             # 这里逻辑可以简化，因为 Key 匹配才是硬道理
             pass 
@@ -165,38 +277,53 @@ class VoiceScheduler:
 
     # ==================== 分发执行 (Polymorphic Dispatch) ====================
 
-    async def _execute_dispatch(self, trigger_key: str, is_compensation: bool):
-        targets = self.plugin.config.get("schedule.target_sessions", [])
-        config_tags = self.plugin.config.get("schedule.voice_tags", [])
+    async def _execute_dispatch(self, pending: List[str], trigger_key: int, is_compensation: bool):
+        config_tags = self._sched.voice_tags
         
-        # 乱序发送，模拟真人操作
-        # list() copy 一份防止修改原配置
-        dispatch_list = list(targets)
+        # 乱序发送，模拟真人操作 (pending 是判定时新建的列表，可直接打乱)
+        dispatch_list = pending
         random.shuffle(dispatch_list)
 
         logger.info(f"[调度器] 开始分发，目标数: {len(dispatch_list)}，模式: {'补偿' if is_compensation else '实时'}")
 
-        for i, session_id in enumerate(dispatch_list):
-            # 1. 幂等性检查 (Double Check)
-            if self.session_sent_keys.get(session_id) == trigger_key:
-                continue
+        # 时间抖动 (Temporal Jitter): 每个会话在窗口内随机错开，并发等待而非逐个累加
+        # 如果是补偿模式，为了尽快发完，窗口小一点；正常模式窗口大一点
+        spread = 1.5 if is_compensation else 8.0
+
+        # 标签轮转：配置了标签时每次分发洗牌一次后依次轮流，各群分布均匀；
+        # 未配置时按时间段选出的标签对本次分发的所有会话都相同，只算一次
+        if config_tags:
+            tag_ring = itertools.cycle(random.sample(config_tags, len(config_tags)))
+        else:
+            tag_ring = itertools.repeat(self._determine_context_tag(config_tags))
+
+        sends = []
+        for session_id in dispatch_list:
+            # 1. 幂等性已在 _check_trigger_condition 中筛过，这里不再复查
 
             # 2. 上下文注入 (Context Injection)
-            final_tag = self._determine_context_tag(config_tags)
+            final_tag = next(tag_ring)
 
             # 3. 多态获取 (Polymorphic Fetch)
             # 每个群独立调用 VoiceManager，配合 v3.0 的去重算法，每个群听到的可能不同
             rel_path = self.voice_manager.get_voice(final_tag)
-            
+
             if rel_path:
-                await self._do_send(session_id, rel_path)
-                self.session_sent_keys[session_id] = trigger_key
-            
-            # 4. 时间抖动 (Temporal Jitter)
-            # 如果是补偿模式，为了尽快发完，抖动小一点；正常模式抖动大一点
-            if i < len(dispatch_list) - 1:
-                jitter = random.uniform(0.5, 1.5) if is_compensation else random.uniform(2.0, 8.0)
-                await asyncio.sleep(jitter)
+                delay = random.uniform(0, spread) if sends else 0.0
+                sends.append(self._send_one(session_id, rel_path, trigger_key, delay))
+
+        # 4. 并发分发，总耗时约等于抖动窗口而非 N 倍
+        if sends:
+            await asyncio.gather(*sends, return_exceptions=True)
+            # 在事件循环上取快照，写盘交给工作线程
+            await asyncio.to_thread(self.save_json, self.state_path, self._sent_keys_snapshot())
+
+    async def _send_one(self, session_id: str, rel_path: str, trigger_key: int, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        async with self._send_sem:
+            await self._do_send(session_id, rel_path)
+        self.session_sent_keys[session_id] = trigger_key
 
     def _determine_context_tag(self, config_tags: List[str]) -> Optional[str]:
         """
@@ -220,40 +347,46 @@ class VoiceScheduler:
     # ==================== 底层发送 ====================
 
     async def _do_send(self, session_id: str, rel_path: str):
-        abs_path = (self.voice_manager.base_dir / rel_path).resolve()
-        if not abs_path.exists():
+        # 与被动回复共用 VoiceManager 的路径/预加载缓存，避免每次发送 resolve + stat
+        record_file = self.voice_manager.get_record_file(rel_path)
+        if record_file is None or self._send_fn is None:
             return
 
         try:
-            if hasattr(self.plugin.context, "send_message"):
-                await self.plugin.context.send_message(
-                    session_id=session_id,
-                    message_chain=[Record(file=str(abs_path))]
-                )
-            elif hasattr(self.plugin.context, "message_sender"):
-                await self.plugin.context.message_sender.send_message(
-                    session_id=session_id,
-                    message_chain=[Record(file=str(abs_path))]
-                )
+            await self._send_fn(
+                session_id=session_id,
+                message_chain=[Record(file=record_file)]
+            )
         except Exception as e:
             logger.warning(f"[调度器] 发送失败 ({session_id}): {e}")
 
+    # ==================== 状态持久化 ====================
+
+    def _load_sent_keys(self):
+        data = self.load_json(self.state_path)
+        keys = data.get("keys")
+        if not isinstance(keys, dict):
+            return
+        self._keys_freq = data.get("freq")
+        self.session_sent_keys = {
+            str(sid): key for sid, key in keys.items() if isinstance(key, int)
+        }
+
+    def _sent_keys_snapshot(self) -> dict:
+        return {"freq": self._keys_freq, "keys": dict(self.session_sent_keys)}
+
     # ==================== 辅助方法 ====================
 
     def _config_changed(self) -> bool:
-        cfg = self.plugin.config
-        signature = str({
-            "en": cfg.get("schedule.enabled"),
-            "tm": cfg.get("schedule.time"),
-            "fr": cfg.get("schedule.frequency"),
-            "tg": tuple(cfg.get("schedule.voice_tags", [])),
-            "tr": tuple(cfg.get("schedule.target_sessions", [])),
-        })
+        snapshot = ScheduleSnapshot(self.plugin.config)
+        signature = snapshot.signature()
         if signature != self._last_config_signature:
             self._last_config_signature = signature
+            self._sched = snapshot
+            if not snapshot.time_valid:
+                logger.warning(f"[定时任务] schedule.time 格式无效: {self.plugin.config.get('schedule.time')!r}，已按 08:00 处理")
             return True
         return False
 
     def _is_enabled(self) -> bool:
-        return (self.plugin.config.get("enabled", True) and 
-                self.plugin.config.get("schedule.enabled", False))
\ No newline at end of file
+        return self._sched.enabled
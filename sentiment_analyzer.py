@@ -7,6 +7,7 @@ import threading
 import logging
 import os
 from pathlib import Path
+from types import MappingProxyType
 from typing import Dict, List, Tuple, Optional, Set, Any
 from collections import defaultdict, OrderedDict
 from dataclasses import dataclass, field, asdict
@@ -29,6 +30,9 @@ class AnalysisResult:
     mixed_emotions: List[Tuple[str, float]]
     context_influence: float = 0.0
 
+# 无情绪命中时共用的空结果 (只读容器，避免被调用方意外修改)
+_EMPTY_RESULT = AnalysisResult(None, 0, 0, 0, "mild", MappingProxyType({}), (), 0.0)
+
 @dataclass
 class FeedbackRecord:
     """用户反馈记录"""
@@ -119,13 +123,13 @@ class LRUCache:
         self.cache: OrderedDict = OrderedDict()
         self.lock = threading.Lock()
     
-    def get(self, key: str) -> Optional[Any]:
+    def get(self, key: Any) -> Optional[Any]:
         with self.lock:
             if key not in self.cache: return None
             self.cache.move_to_end(key)
             return self.cache[key]
     
-    def put(self, key: str, value: Any):
+    def put(self, key: Any, value: Any):
         with self.lock:
             if key in self.cache:
                 self.cache.move_to_end(key)
@@ -153,6 +157,11 @@ class SentimentAnalyzer(ThreadSafeIO):
             "preferences": self.data_dir / "user_preferences.json"
         }
 
+        # 上下文持久化：变更后延迟合并写出，同一窗口内的多次更新只落盘一次
+        self._context_lock = threading.Lock()
+        self._context_save_timer: Optional[threading.Timer] = None
+        self._context_dirty = False
+
         # 初始化配置与数据
         self._init_config()
         self._init_regex()
@@ -169,6 +178,7 @@ class SentimentAnalyzer(ThreadSafeIO):
             "enable_context": True,           # 启用上下文记忆
             "context_window": 10,             # 上下文记忆长度
             "negation_lookback": 12,          # 分句内否定词回溯距离
+            "context_save_delay": 5.0,        # 上下文变更后延迟写盘的秒数 (合并写入)
             "intensity_thresholds": {
                 "mild": 3.0, "moderate": 6.0, "severe": 8.5
             }
@@ -202,6 +212,83 @@ class SentimentAnalyzer(ThreadSafeIO):
         self.re_question = re.compile(r"(你|您|特|皇|殿|博).*[?？吗]")
         # v3.1: 反问句检测正则 (难道不...吗)
         self.re_rhetorical = re.compile(r"(难道|怎么会|岂|哪能|怎会).*[?？吗]")
+        # 修饰词合并正则：每类一次扫描代替逐词查找
+        self.re_force_positive = self._compile_alternation(self.FORCE_POSITIVE)
+        self.re_modifiers = {
+            mod_type: self._compile_alternation(data["words"])
+            for mod_type, data in self.MODIFIERS.items()
+        }
+
+    @staticmethod
+    def _compile_alternation(words) -> re.Pattern:
+        """将词表编译为单个交替正则 (长词优先)，词表预先转小写以匹配小写化的文本"""
+        ordered = sorted({w.lower() for w in words}, key=len, reverse=True)
+        return re.compile("|".join(re.escape(w) for w in ordered))
+
+    # 正则源码中的反向引用 (\1 / (?P=name))
+    _RE_BACKREF = re.compile(r"\\[1-9]|\(\?P=")
+
+    def _build_node_arrays(self):
+        """将情感节点拆为并行数组 (SoA)，分析热循环直接按位取值，免去逐节点 dict 查找"""
+        nodes = self.EMOTION_NODES.values()
+        self._node_tags = tuple(self.EMOTION_NODES)
+        self._node_base = tuple(n['base_score'] for n in nodes)
+        self._node_prio = tuple(n['priority'] for n in nodes)
+        self._node_regex = tuple(tuple(n['compiled_regex']) for n in nodes)
+        self._node_skip = tuple(tuple(n['compiled_skip']) for n in nodes)
+        self._node_emojis = tuple(tuple(n.get('emojis', [])) for n in nodes)
+
+        # 全部节点正则合并为一个预筛正则：整段文本无一命中时跳过逐条 finditer
+        # 含反向引用的自定义正则合并后组号会错位，此时不启用预筛
+        patterns = [p.pattern for regs in self._node_regex for p in regs]
+        self.re_any_regex = None
+        if patterns and not any(self._RE_BACKREF.search(p) for p in patterns):
+            try:
+                self.re_any_regex = re.compile(
+                    "|".join(f"(?:{p})" for p in patterns), re.IGNORECASE
+                )
+            except re.error:
+                pass
+
+        # 全部节点 emoji 合并为一个预筛正则 (按原文大小写匹配，与 text.count 一致)
+        emojis = sorted({e for es in self._node_emojis for e in es}, key=len, reverse=True)
+        self.re_any_emoji = re.compile("|".join(re.escape(e) for e in emojis)) if emojis else None
+
+    def _build_keyword_matcher(self):
+        """
+        将所有情感关键词编译为单个前瞻正则，一次扫描找出文本中出现的全部关键词。
+        前瞻匹配在每个位置给出最长关键词，再通过包含表补齐被其覆盖的短关键词。
+        """
+        # 关键词 -> 所属情感标签 (词表内重复出现的词保留重复，与逐词匹配计分一致)
+        # 关键词在此统一转小写：文本侧已小写化，自定义词库中的大写词否则永远无法命中
+        self._kw_tags: Dict[str, List[str]] = defaultdict(list)
+        for tag, data in self.EMOTION_NODES.items():
+            for kw in data.get('keywords', []):
+                self._kw_tags[kw.lower()].append(tag)
+
+        keywords = [k for k in self._kw_tags if k]
+        # 关键词 -> 其自身及其包含的所有其他关键词
+        self._kw_contains: Dict[str, Tuple[str, ...]] = {
+            k: tuple(o for o in keywords if o in k) for k in keywords
+        }
+        ordered = sorted(keywords, key=len, reverse=True)
+        self.re_keywords = re.compile(
+            "(?=(" + "|".join(re.escape(k) for k in ordered) + "))"
+        ) if ordered else None
+
+    def _find_keywords(self, text_lower: str) -> Dict[str, List[str]]:
+        """返回 { tag: [命中的关键词] }"""
+        if self.re_keywords is None:
+            return {}
+        present: Set[str] = set()
+        for m in self.re_keywords.finditer(text_lower):
+            present.update(self._kw_contains[m.group(1)])
+
+        hits: Dict[str, List[str]] = defaultdict(list)
+        for kw in present:
+            for tag in self._kw_tags[kw]:
+                hits[tag].append(kw)
+        return hits
     
     def _load_data(self):
         """加载数据"""
@@ -218,6 +305,8 @@ class SentimentAnalyzer(ThreadSafeIO):
             node['compiled_regex'] = [re.compile(p, re.IGNORECASE) for p in node.get('regex', [])]
             # v3.1: 预编译排除项 (Anti-Patterns)
             node['compiled_skip'] = [re.compile(p, re.IGNORECASE) for p in node.get('skip_patterns', [])]
+        self._build_node_arrays()
+        self._build_keyword_matcher()
 
         # 2. 加载上下文与用户数据
         self.context_memory = {k: ContextMemory(**v) for k, v in self.load_json(self.files["context"], {}).items()}
@@ -225,19 +314,21 @@ class SentimentAnalyzer(ThreadSafeIO):
 
     # ================= 核心分析逻辑 =================
 
-    def analyze(self, text: str, user_id: Optional[str] = None) -> Tuple[Optional[str], float]:
-        """主入口：执行情感分析"""
+    def analyze(self, text: str, user_id: Optional[str] = None,
+                enable_negation: bool = True,
+                text_lower: Optional[str] = None) -> Tuple[Optional[str], float]:
+        """主入口：执行情感分析 (调用方已有小写文本时可通过 text_lower 传入复用)"""
         if not text:
             return None, 0.0
         
-        # 1. 检查缓存
-        cache_key = f"{user_id or 'anon'}:{text[:100]}"
+        # 1. 检查缓存 (键包含完整文本与影响结果的开关)
+        cache_key = (user_id or 'anon', enable_negation, text)
         cached_result = self.cache.get(cache_key)
-        if cached_result:
+        if cached_result is not None:
             return cached_result.tag, cached_result.score
         
         # 2. 执行核心分析
-        result = self._analyze_core(text, user_id)
+        result = self._analyze_core(text, user_id, enable_negation, text_lower)
         
         # 3. 更新上下文
         if self.CONFIG["enable_context"] and user_id:
@@ -247,12 +338,16 @@ class SentimentAnalyzer(ThreadSafeIO):
         self.cache.put(cache_key, result)
         return result.tag, result.score
 
-    def get_analysis_details(self, text: str, user_id: Optional[str] = None) -> AnalysisResult:
+    def get_analysis_details(self, text: str, user_id: Optional[str] = None,
+                             enable_negation: bool = True) -> AnalysisResult:
         """获取详细分析结果"""
-        return self._analyze_core(text, user_id)
+        return self._analyze_core(text, user_id, enable_negation)
 
-    def _analyze_core(self, text: str, user_id: Optional[str]) -> AnalysisResult:
-        text_lower = text.lower()
+    def _analyze_core(self, text: str, user_id: Optional[str],
+                      enable_negation: bool = True,
+                      text_lower: Optional[str] = None) -> AnalysisResult:
+        if text_lower is None or len(text_lower) != len(text):
+            text_lower = text.lower()
         
         # A. 智能分句
         segments = self._segment_text(text_lower)
@@ -263,25 +358,30 @@ class SentimentAnalyzer(ThreadSafeIO):
         
         # v3.1: 检测是否为反问句 (反问句通常表示强烈肯定)
         is_rhetorical = bool(self.re_rhetorical.search(text))
+
+        # 单次扫描找出全部命中的关键词
+        keyword_hits = self._find_keywords(text_lower)
+        # 合并预筛：无任何节点正则可能命中时跳过逐条正则扫描
+        regex_possible = self.re_any_regex is None or self.re_any_regex.search(text_lower) is not None
+        # 同理：文本中没有任何 emoji 时跳过逐个 text.count 扫描 (绝大多数消息)
+        emoji_possible = self.re_any_emoji is not None and self.re_any_emoji.search(text) is not None
         
         # B. 遍历情感节点
-        for tag, data in self.EMOTION_NODES.items():
-            base_score = data['base_score']
-            priority = data['priority']
-            compiled_skip = data.get('compiled_skip', [])
+        for tag, base_score, priority, compiled_regex, compiled_skip, emojis in zip(
+                self._node_tags, self._node_base, self._node_prio,
+                self._node_regex, self._node_skip, self._node_emojis):
             
             # --- 关键词匹配 ---
-            for kw in data['keywords']:
-                if kw not in text_lower: continue
-                
-                # v3.1: 检查全局黑名单 (如 "笑死" 不应触发 "death")
-                if self._check_skip_patterns(text_lower, compiled_skip):
-                    continue
+            # v3.1: 检查全局黑名单 (如 "笑死" 不应触发 "death")
+            hit_kws = keyword_hits.get(tag)
+            if hit_kws and self._check_skip_patterns(text_lower, compiled_skip):
+                hit_kws = None
 
+            for kw in hit_kws or ():
                 for seg_idx, segment in enumerate(segments):
                     if kw in segment:
                         # 计算修饰符 (核心逻辑)
-                        mod_weight = self._calculate_segment_modifier(segment, kw, is_rhetorical)
+                        mod_weight = self._calculate_segment_modifier(segment, kw, is_rhetorical, enable_negation)
                         
                         # 边际效应递减
                         count = segment.count(kw)
@@ -298,7 +398,7 @@ class SentimentAnalyzer(ThreadSafeIO):
                             match_details[tag].append(f"{kw}({mod_weight:.1f})")
 
             # --- 正则匹配 ---
-            for pattern in data['compiled_regex']:
+            for pattern in (compiled_regex if regex_possible else ()):
                 for match in pattern.finditer(text_lower):
                     # v3.1: 正则也要检查反模式
                     if self._check_skip_patterns(match.group(), compiled_skip):
@@ -311,7 +411,7 @@ class SentimentAnalyzer(ThreadSafeIO):
 
             # --- Emoji 统计 ---
             emoji_score = 0.0
-            for emoji in data.get('emojis', []):
+            for emoji in (emojis if emoji_possible else ()):
                 count = text.count(emoji)
                 if count > 0:
                     factor = (1 + math.log10(count)) if self.CONFIG["enable_diminishing"] else count
@@ -321,7 +421,7 @@ class SentimentAnalyzer(ThreadSafeIO):
 
         # C. 后处理
         if not final_scores:
-            return AnalysisResult(None, 0, 0, 0, "mild", {}, [], 0.0)
+            return _EMPTY_RESULT
 
         # 全局加强 (感叹号)
         global_boost = 1.0 + (0.15 * min(text.count('!'), 3))
@@ -347,7 +447,7 @@ class SentimentAnalyzer(ThreadSafeIO):
                 candidates.append((k, final_v, max_priorities[k]))
 
         if not candidates:
-            return AnalysisResult(None, 0, 0, 0, "mild", {}, [], 0.0)
+            return _EMPTY_RESULT
 
         # 排序：优先高优先级(且分数足够高)，否则按分数
         sorted_candidates = sorted(
@@ -367,7 +467,7 @@ class SentimentAnalyzer(ThreadSafeIO):
             priority=best_prio,
             confidence=min(best_score / 12.0, 1.0),
             intensity=intensity,
-            details=dict(match_details[best_tag]),
+            details={"matches": match_details[best_tag]},
             mixed_emotions=[(t, s) for t, s, _ in candidates if t != best_tag and s > best_score * 0.6],
             context_influence=ctx_influence.get(best_tag, 0.0)
         )
@@ -379,7 +479,8 @@ class SentimentAnalyzer(ThreadSafeIO):
                 return True
         return False
 
-    def _calculate_segment_modifier(self, segment: str, keyword: str, is_rhetorical: bool) -> float:
+    def _calculate_segment_modifier(self, segment: str, keyword: str, is_rhetorical: bool,
+                                    enable_negation: bool = True) -> float:
         """v3.1: 计算修饰符 (双重否定 + 反问逻辑)"""
         kw_idx = segment.find(keyword)
         if kw_idx == -1: return 1.0
@@ -391,16 +492,13 @@ class SentimentAnalyzer(ThreadSafeIO):
         lookback = self.CONFIG["negation_lookback"]
         
         # 1. 强制肯定词组
-        for pos_phrase in self.FORCE_POSITIVE:
-            if pos_phrase in pre_text:
-                return 1.3 
+        if self.re_force_positive.search(pre_text):
+            return 1.3 
         
-        # 2. 统计否定词数量
+        # 2. 统计回溯窗口内出现的不同否定词数量
         neg_count = 0
-        for neg_word in self.MODIFIERS["negate"]["words"]:
-            idx = pre_text.rfind(neg_word)
-            if idx != -1 and (len(pre_text) - idx) <= lookback:
-                neg_count += 1
+        if enable_negation:
+            neg_count = len(set(self.re_modifiers["negate"].findall(pre_text[-lookback:])))
         
         # 奇数否定翻转，偶数否定(双重否定)加强
         if neg_count % 2 == 1:
@@ -412,15 +510,11 @@ class SentimentAnalyzer(ThreadSafeIO):
         if is_rhetorical and multiplier < 0:
             multiplier *= -1.5
         
-        # 4. 程度副词
-        found_mods = set()
+        # 4. 程度副词 (每类至多生效一次)
         for mod_type, data in self.MODIFIERS.items():
             if mod_type == "negate": continue
-            for word in data["words"]:
-                if word in pre_text and word not in found_mods:
-                    multiplier *= data["weight"]
-                    found_mods.add(word)
-                    break
+            if self.re_modifiers[mod_type].search(pre_text):
+                multiplier *= data["weight"]
                     
         return multiplier
 
@@ -443,24 +537,39 @@ class SentimentAnalyzer(ThreadSafeIO):
         return {ctx.current_mood: 0.2 * decay_factor}
 
     def _update_context(self, user_id: str, result: AnalysisResult):
-        if user_id not in self.context_memory:
-            self.context_memory[user_id] = ContextMemory(user_id=user_id)
-        ctx = self.context_memory[user_id]
-        now = time.time()
-        
-        if result.tag:
-            ctx.current_mood = result.tag
-            ctx.mood_intensity = result.score
-            ctx.emotion_history.append((result.tag, result.score, now))
-        
-        ctx.last_update = now
-        if len(ctx.emotion_history) > self.CONFIG["context_window"]:
-            ctx.emotion_history.pop(0)
+        with self._context_lock:
+            if user_id not in self.context_memory:
+                self.context_memory[user_id] = ContextMemory(user_id=user_id)
+            ctx = self.context_memory[user_id]
+            now = time.time()
             
-        threading.Thread(target=self._save_context_async, args=(user_id,)).start()
-
-    def _save_context_async(self, user_id: str):
-        data = {uid: asdict(mem) for uid, mem in self.context_memory.items()}
+            if result.tag:
+                ctx.current_mood = result.tag
+                ctx.mood_intensity = result.score
+                ctx.emotion_history.append((result.tag, result.score, now))
+            
+            ctx.last_update = now
+            if len(ctx.emotion_history) > self.CONFIG["context_window"]:
+                ctx.emotion_history.pop(0)
+
+            self._context_dirty = True
+            if self._context_save_timer is not None:
+                return
+            timer = threading.Timer(self.CONFIG["context_save_delay"], self.flush_context)
+            timer.daemon = True
+            self._context_save_timer = timer
+        timer.start()
+
+    def flush_context(self):
+        """立即写出待保存的上下文记忆 (卸载时调用，也是延迟写入的回调)"""
+        with self._context_lock:
+            timer, self._context_save_timer = self._context_save_timer, None
+            if not self._context_dirty:
+                return
+            self._context_dirty = False
+            data = {uid: asdict(mem) for uid, mem in self.context_memory.items()}
+        if timer is not None:
+            timer.cancel()
         self.save_json(self.files["context"], data)
 
     def _get_user_weight_multiplier(self, user_id: Optional[str], tag: str) -> float:
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import base64
+import os
 import random
 import re
 import time
@@ -7,16 +9,23 @@ from collections import deque
 from typing import List, Set, Optional, Dict, Deque
 from astrbot.api import logger
 
+# 语音抽取共用的随机数生成器
+_rng = random.Random()
+
 
 class VoiceEntry:
-    __slots__ = ("rel_path", "tags", "base_weights", "usage_count", "last_used")
+    __slots__ = ("rel_path", "stem", "tags", "base_weights", "usage_count", "last_used", "seq")
 
     def __init__(self, rel_path: str, tags: Set[str], weights: Dict[str, int]):
         self.rel_path = rel_path
+        # 小写文件名 (无扩展名)，供模糊回退匹配，免去每次查询构造 Path
+        self.stem = Path(rel_path).stem.lower()
         self.tags = {str(t).lower() for t in tags}
         self.base_weights = {str(k).lower(): int(v) for k, v in weights.items()}
         self.usage_count = 0
         self.last_used = 0.0
+        # 加载序号，多标签并集时据此恢复加载顺序
+        self.seq = 0
 
     def get_weight(self, tag: str) -> float:
         base = self.base_weights.get(tag, 1)
@@ -118,6 +127,11 @@ class VoiceManager:
         "thanks": ["non_3_star", "trust"],              # 谢谢 -> 非3星(互谢)
     }
 
+    # 预加载单文件上限 (字节)，超过则仍按路径发送
+    PRELOAD_MAX_BYTES = 2 * 1024 * 1024
+    # 模糊回退缓存的标签数上限 (标签可能来自用户指令输入)
+    FALLBACK_CACHE_SIZE = 256
+
     def __init__(self, plugin):
         self.plugin = plugin
         self.base_dir = Path(__file__).parent.resolve()
@@ -125,6 +139,15 @@ class VoiceManager:
 
         self.entries: List[VoiceEntry] = []
         self.all_tags: Set[str] = set()
+        # 标签倒排索引：{ tag: [VoiceEntry, ...] }，加载时构建，避免每次查询全表扫描
+        self._by_tag: Dict[str, List[VoiceEntry]] = {}
+        self._sorted_tags: List[str] = []
+        # 绝对路径缓存：{ rel_path: 绝对路径 或 None(文件缺失) }，重新加载语音库时清空
+        self._abs_path_cache: Dict[str, Optional[Path]] = {}
+        # 预加载缓存：{ rel_path: "base64://..." }，仅在 voice.preload 开启时填充
+        self._preload_cache: Dict[str, str] = {}
+        # 模糊回退缓存：{ tag: [VoiceEntry, ...] }，索引未命中的标签 (如库中没有 poke) 只扫描一次
+        self._fallback_cache: Dict[str, List[VoiceEntry]] = {}
         # 历史队列：记录最近 5 次播放的路径，防止重复
         self.history_queue: Deque[str] = deque(maxlen=5)
 
@@ -132,22 +155,30 @@ class VoiceManager:
 
     def load_voices(self) -> None:
         logger.info("[Echo Voice v3.2] 正在加载特雷西娅语音库 (深度语义版)...")
-        self.entries.clear()
-        self.all_tags.clear()
         self._scan_voices()
 
     def update_voices(self) -> None:
-        self.entries.clear()
-        self.all_tags.clear()
         self._scan_voices()
 
     def _scan_voices(self) -> None:
-        if not self.voice_dir.exists():
+        """
+        扫描语音目录并重建索引。
+        新索引先在局部变量中构建完毕再整体替换，可在工作线程中执行而不影响并发的查询。
+        """
+        entries: List[VoiceEntry] = []
+        all_tags: Set[str] = set()
+        by_tag: Dict[str, List[VoiceEntry]] = {}
+        abs_path_cache: Dict[str, Optional[Path]] = {}
+        preload_cache: Dict[str, str] = {}
+
+        dir_exists = self.voice_dir.exists()
+        if not dir_exists:
             self.voice_dir.mkdir(parents=True, exist_ok=True)
-            return
-
-        audio_extensions = {".mp3", ".wav", ".ogg", ".m4a", ".silk", ".aac", ".flac"}
-        files = [f for f in self.voice_dir.iterdir() if f.is_file() and f.suffix.lower() in audio_extensions]
+            files = []
+        else:
+            audio_extensions = {".mp3", ".wav", ".ogg", ".m4a", ".silk", ".aac", ".flac"}
+            files = [f for f in self.voice_dir.iterdir() if f.is_file() and f.suffix.lower() in audio_extensions]
+        preload = self.plugin.config.get("voice.preload", False)
 
         for file_path in files:
             # 相对路径
@@ -159,11 +190,66 @@ class VoiceManager:
             tags.add("theresia")
             weights.setdefault("theresia", 1)
 
+            # 扫描时文件必然存在，顺带填充路径缓存，发送时无需在事件循环上 stat
+            abs_path_cache[rel_path] = file_path.resolve()
+
             entry = VoiceEntry(rel_path=rel_path, tags=tags, weights=weights)
-            self.entries.append(entry)
-            self.all_tags.update(entry.tags)
-        
-        logger.info(f"[Echo Voice] 加载完成，共 {len(self.entries)} 条语音，覆盖 {len(self.all_tags)} 个标签")
+            entry.seq = len(entries)
+            entries.append(entry)
+            all_tags.update(entry.tags)
+            for t in entry.tags:
+                by_tag.setdefault(t, []).append(entry)
+
+            if preload:
+                data_uri = self._preload(rel_path, file_path)
+                if data_uri is not None:
+                    preload_cache[rel_path] = data_uri
+
+        # 整体替换
+        self.entries = entries
+        self.all_tags = all_tags
+        self._by_tag = by_tag
+        self._sorted_tags = sorted(all_tags)
+        self._abs_path_cache = abs_path_cache
+        self._preload_cache = preload_cache
+        self._fallback_cache = {}
+
+        if dir_exists:
+            logger.info(f"[Echo Voice] 加载完成，共 {len(entries)} 条语音，覆盖 {len(all_tags)} 个标签")
+        if preload:
+            logger.info(f"[Echo Voice] 已预加载 {len(preload_cache)} 条语音到内存")
+
+    def prewarm(self) -> None:
+        """
+        提示内核预读全部语音文件到页缓存，减少首次发送时的磁盘延迟。
+        仅在支持 posix_fadvise 的平台生效；阻塞调用，应在工作线程中执行。
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        count = 0
+        for rel_path, abs_path in list(self._abs_path_cache.items()):
+            if abs_path is None or rel_path in self._preload_cache:
+                continue
+            try:
+                fd = os.open(abs_path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+                count += 1
+            except OSError:
+                continue
+        logger.debug(f"[Echo Voice] 已预热 {count} 个语音文件的页缓存")
+
+    def _preload(self, rel_path: str, file_path: Path) -> Optional[str]:
+        try:
+            if file_path.stat().st_size > self.PRELOAD_MAX_BYTES:
+                return None
+            data = file_path.read_bytes()
+        except OSError as e:
+            logger.warning(f"[Echo Voice] 预加载失败: {rel_path} ({e})")
+            return None
+        return "base64://" + base64.b64encode(data).decode("ascii")
 
     def _extract_tags(self, filename: str) -> (Set[str], Dict[str, int]):
         tags: Set[str] = set()
@@ -211,15 +297,25 @@ class VoiceManager:
             # 无标签：全选
             candidates = self.entries
         else:
-            # 有标签：取交集
-            for entry in self.entries:
-                if not entry.tags.isdisjoint(search_tags):
-                    candidates.append(entry)
+            # 有标签：查倒排索引取并集 (按 id 去重)
+            seen = set()
+            for t in search_tags:
+                for entry in self._by_tag.get(t, ()):
+                    if id(entry) not in seen:
+                        seen.add(id(entry))
+                        candidates.append(entry)
+            # 单个标签的索引列表本身即加载顺序；多个标签 (同义词扩充) 的遍历顺序取决于 set，需按序号恢复
+            if len(search_tags) > 1:
+                candidates.sort(key=lambda e: e.seq)
 
         # 3. 模糊文件名回退 (Fallback)
         if not candidates and tag:
             t = str(tag).lower()
-            candidates = [e for e in self.entries if t in Path(e.rel_path).stem.lower()]
+            candidates = self._fallback_cache.get(t)
+            if candidates is None:
+                candidates = [e for e in self.entries if t in e.stem]
+                if len(self._fallback_cache) < self.FALLBACK_CACHE_SIZE:
+                    self._fallback_cache[t] = candidates
 
         if not candidates:
             return None
@@ -238,7 +334,6 @@ class VoiceManager:
             available_pool = candidates
 
         # 5. 动态权重计算 (Dynamic Scoring)
-        weighted_pool = []
         weights = []
         
         for entry in available_pool:
@@ -251,14 +346,20 @@ class VoiceManager:
             if not entry.tags.isdisjoint(search_tags):
                 w *= 1.5
 
-            weighted_pool.append(entry)
             weights.append(w)
 
-        # 6. 加权随机选择
-        try:
-            chosen_entry = random.choices(weighted_pool, weights=weights, k=1)[0]
-        except (IndexError, ValueError):
-            chosen_entry = random.choice(available_pool)
+        # 6. 加权随机选择 (单次抽样 + 累减，权重全为 0 时退化为均匀随机)
+        total = sum(weights)
+        if total > 0:
+            r = _rng.random() * total
+            chosen_entry = available_pool[-1]
+            for entry, w in zip(available_pool, weights):
+                r -= w
+                if r < 0:
+                    chosen_entry = entry
+                    break
+        else:
+            chosen_entry = _rng.choice(available_pool)
 
         # 7. 更新状态
         self._update_stats(chosen_entry)
@@ -273,17 +374,35 @@ class VoiceManager:
         self.history_queue.append(entry.rel_path)
         
         # 老化机制：极小概率衰减所有计数，防止永久低权重
-        if random.random() < 0.05:
+        if _rng.random() < 0.05:
             for e in self.entries:
                 if e.usage_count > 0:
                     e.usage_count = int(e.usage_count * 0.9)
 
     # ==================== 工具方法 ====================
 
+    def resolve_voice(self, rel_path: str) -> Optional[Path]:
+        """相对路径 -> 绝对路径，文件不存在返回 None；结果缓存到下次重新加载"""
+        try:
+            return self._abs_path_cache[rel_path]
+        except KeyError:
+            pass
+        abs_path = (self.base_dir / rel_path).resolve()
+        result = abs_path if abs_path.exists() else None
+        self._abs_path_cache[rel_path] = result
+        return result
+
+    def get_record_file(self, rel_path: str) -> Optional[str]:
+        """Record 组件的 file 参数：优先使用预加载的 base64 数据，否则为绝对路径"""
+        cached = self._preload_cache.get(rel_path)
+        if cached is not None:
+            return cached
+        abs_path = self.resolve_voice(rel_path)
+        return str(abs_path) if abs_path is not None else None
+
     def get_tags(self) -> List[str]:
-        return sorted(self.all_tags)
+        return list(self._sorted_tags)
 
     def get_voice_count(self, tag: Optional[str] = None) -> int:
         if not tag: return len(self.entries)
-        t = str(tag).lower()
-        return sum(1 for e in self.entries if t in e.tags)
\ No newline at end of file
+        return len(self._by_tag.get(str(tag).lower(), ()))